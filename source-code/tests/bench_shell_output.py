@@ -0,0 +1,106 @@
+"""Benchmark for the interactive shell reader: throughput on multi-MB outputs.
+
+Feeds an in-memory channel with mixed Chinese/ASCII output in fixed-size recv pieces (so multibyte characters
+are split across recv boundaries), runs the session's pump thread over it and reads the stream the way the
+tools do, then checks the text is identical to the source. For comparison it also times the old reader,
+which decoded each recv on its own with errors='ignore' and grew the output with +=.
+
+    python tests/bench_shell_output.py --size-mb 10 --chunk 32768
+    python tests/bench_shell_output.py --mode screen      # also mirror into the virtual screen
+"""
+import argparse
+import importlib
+import os
+import sys
+import threading
+import time
+from typing import Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+toolkit = importlib.import_module("linux_mcp_toolkit.main")
+
+LINE = "2024-01-01 12:00:00 服务启动完成 worker=%d status=正常 ok\r\n"
+
+
+class MemoryChannel:
+    """Shell channel stand-in that hands out a prepared byte string in recv pieces of at most chunk bytes"""
+
+    def __init__(self, data: bytes, chunk: int):
+        self.data = data
+        self.chunk = chunk
+        self.position = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def recv(self, size: int) -> bytes:
+        with self.lock:
+            piece = self.data[self.position:self.position + min(size, self.chunk)]
+            self.position += len(piece)
+            return piece
+
+    def recv_ready(self) -> bool:
+        return self.position < len(self.data)
+
+    def close(self):
+        self.closed = True
+
+
+def make_output(size: int) -> str:
+    lines, total, index = [], 0, 0
+    while total < size:
+        line = LINE % index
+        lines.append(line)
+        total += len(line.encode("utf-8"))
+        index += 1
+    return "".join(lines)
+
+
+def run_pump(data: bytes, chunk: int, screen: bool) -> Tuple[str, float]:
+    session = toolkit.InteractiveShell("bench")
+    # 保留全部输出以便逐字比较（默认只保留最近SESSION_STREAM_CHARS个字符）
+    session.stream = toolkit.SessionStream(limit=len(data))
+    if screen:
+        session.enable_screen()
+    session.shell = MemoryChannel(data, chunk)
+    session.recv_size = max(toolkit.SHELL_RECV_SIZE, chunk)
+    start = time.perf_counter()
+    pump = threading.Thread(target=session._pump, args=(session.shell,), daemon=True)
+    pump.start()
+    pieces = []
+    while True:
+        pieces.append(session._read_output())
+        if session.stream.closed and session.read_offset >= session.stream.end:
+            break
+        session.wait_output(session.read_offset, 1)
+    pump.join()
+    return "".join(pieces), time.perf_counter() - start
+
+
+def run_old(data: bytes, chunk: int) -> Tuple[str, float]:
+    channel = MemoryChannel(data, chunk)
+    start = time.perf_counter()
+    output = ""
+    while channel.recv_ready():
+        output += channel.recv(4096).decode("utf-8", errors="ignore")
+    return output, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=10, help="output size in MB")
+    parser.add_argument("--chunk", type=int, default=32768, help="largest piece one recv returns")
+    parser.add_argument("--mode", choices=["raw", "screen"], default="raw", help="screen: also feed the virtual screen")
+    args = parser.parse_args()
+
+    text = make_output(int(args.size_mb * 1024 * 1024))
+    data = text.encode("utf-8")
+    size_mb = len(data) / 1024 / 1024
+    print(f"{size_mb:.1f} MB output, {args.chunk} byte recv pieces, mode {args.mode}")
+    print(f"{'reader':>8} {'seconds':>8} {'MB/s':>8} {'chars lost':>11} {'identical':>10}")
+    for name, (output, elapsed) in (("pump", run_pump(data, args.chunk, args.mode == "screen")),
+                                    ("old", run_old(data, args.chunk))):
+        print(f"{name:>8} {elapsed:>8.3f} {size_mb / elapsed:>8.1f} {len(text) - len(output):>11} {str(output == text):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Load test for the multi-client HTTP transport: how tool-call throughput scales with the number of clients.
+
+Starts the server with --transport streamable-http on a free local port, then for each client count runs that
+many concurrent MCP sessions, each calling execute_command in a loop for --duration seconds, and prints
+calls/s and latency percentiles. The target host defaults to HOST (or 127.0.0.1, served by the local backend).
+
+    python tests/load_http_clients.py --clients 1,2,4,8,16 --command "sleep 0.2; echo hi"
+    python tests/load_http_clients.py --workers 1      # serial tool execution, for comparison
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from mcp import ClientSession
+from mcp.client.streamable_http import streamablehttp_client
+
+SOURCE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, workers: int) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONPATH=SOURCE_ROOT, MCP_TOOL_WORKERS=str(workers))
+    server = subprocess.Popen([sys.executable, "-c", "from linux_mcp_toolkit.main import main; main()",
+                               "--transport", "streamable-http", "--port", str(port)],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("server exited during startup")
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("server did not start listening")
+
+
+async def client(url: str, arguments: dict, stop: float, latencies: list, errors: list):
+    async with streamablehttp_client(url) as (read, write, _):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+            while time.perf_counter() < stop:
+                start = time.perf_counter()
+                result = await session.call_tool("execute_command", arguments)
+                elapsed = time.perf_counter() - start
+                if json.loads(result.content[0].text).get("ok"):
+                    latencies.append(elapsed)
+                else:
+                    errors.append(result.content[0].text)
+
+
+async def run_level(url: str, clients: int, arguments: dict, duration: float) -> dict:
+    latencies, errors = [], []
+    stop = time.perf_counter() + duration
+    await asyncio.gather(*(client(url, arguments, stop, latencies, errors) for _ in range(clients)))
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000 if latencies else 0.0
+    return {'clients': clients, 'calls': len(latencies), 'errors': len(errors), 'rate': len(latencies) / duration,
+            'p50_ms': pick(0.5), 'p95_ms': pick(0.95)}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", default="1,2,4,8,16,32", help="comma-separated client counts")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per client count")
+    parser.add_argument("--command", default="echo hi", help="command each call runs")
+    parser.add_argument("--target", default=os.environ.get('HOST', '127.0.0.1'), help="host the commands run on")
+    parser.add_argument("--workers", type=int, default=64, help="MCP_TOOL_WORKERS for the server")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = start_server(port, args.workers)
+    url = f"http://127.0.0.1:{port}/mcp"
+    arguments = {"command": args.command, "ip_address": args.target, "format": "json"}
+    try:
+        print(f"{'clients':>7} {'calls/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+        for clients in [int(n) for n in args.clients.split(",")]:
+            level = await run_level(url, clients, arguments, args.duration)
+            print(f"{level['clients']:>7} {level['rate']:>9.1f} {level['p50_ms']:>8.1f} {level['p95_ms']:>8.1f} {level['errors']:>7}")
+    finally:
+        server.terminate()
+        server.wait(10)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
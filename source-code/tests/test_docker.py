@@ -0,0 +1,450 @@
+"""Docker API tools against a stand-in daemon on a Unix socket.
+
+The daemon serves canned Engine API responses (chunked lists, multiplexed and TTY log streams, endless stats
+streams, error statuses). Each test runs over every way the toolkit reaches a host's socket: directly (local
+backend), through a direct-streamlocal channel, and through the exec relay (socat, or python3 when socat is
+missing) of an in-process paramiko SSH server that refuses Unix socket forwarding.
+"""
+import importlib
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+import paramiko
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+toolkit = importlib.import_module("linux_mcp_toolkit.main")
+
+HOST = "127.0.0.1"
+
+CONTAINERS = [
+    {"Id": "a" * 64, "Names": ["/web"], "Image": "nginx:1.25", "State": "running", "Status": "Up 2 hours",
+     "Ports": [{"IP": "0.0.0.0", "PublicPort": 8080, "PrivatePort": 80, "Type": "tcp"}], "Created": 1700000000,
+     "Labels": {"tier": "front"}},
+    {"Id": "b" * 64, "Names": ["/console"], "Image": "busybox", "State": "running", "Status": "Up 5 minutes",
+     "Ports": [], "Created": 1700000100, "Labels": {}},
+]
+INSPECT = {
+    "Id": "a" * 64, "Name": "/web", "RestartCount": 1,
+    "State": {"Status": "running", "Running": True, "Pid": 4242, "StartedAt": "2024-01-01T00:00:00Z"},
+    "Config": {"Image": "nginx:1.25", "Entrypoint": ["/docker-entrypoint.sh"], "Cmd": ["nginx", "-g", "daemon off;"]},
+    "NetworkSettings": {"Ports": {"80/tcp": [{"HostIp": "0.0.0.0", "HostPort": "8080"}]},
+                        "Networks": {"bridge": {"IPAddress": "172.17.0.2"}}},
+    "Mounts": [{"Type": "bind", "Source": "/srv/www", "Destination": "/usr/share/nginx/html", "RW": False}],
+}
+# (stream, unix second, message): stream 1 is stdout, 2 is stderr
+WEB_LOGS = [(1, 1704067201, "start"), (1, 1704067202, "GET /"), (2, 1704067203, "warn: slow"),
+            (1, 1704067204, "GET /health"), (2, 1704067205, "error: upstream")]
+TTY_LOGS = [(1704067201, "login: "), (1704067202, "$ ls"), (1704067203, "bin etc")]
+
+
+def stamp(seconds: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + ".000000001Z"
+
+
+def split(data: bytes, size: int = 7):
+    """Chunk boundaries that split frame headers and lines"""
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class DockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status: int, body, chunked: bool = False):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.write_chunks(split(data, 50))
+        else:
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    def write_chunks(self, pieces):
+        for piece in pieces:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(piece), piece))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def start_stream(self, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, query))
+        parts = url.path.strip("/").split("/")
+        if url.path == "/containers/json":
+            # 列表以分块编码分多段返回
+            return self.send_json(200, CONTAINERS, chunked=True)
+        if url.path == "/containers/broken/json":
+            return self.send_json(500, {"message": "boom"})
+        if len(parts) != 3 or parts[0] != "containers" or parts[1] not in ("web", "console"):
+            return self.send_json(404, {"message": f"No such container: {parts[1] if len(parts) > 1 else ''}"})
+        if parts[2] == "json":
+            return self.send_json(200, INSPECT)
+        if parts[2] == "logs":
+            return self.send_logs(parts[1], query)
+        if parts[2] == "stats":
+            return self.send_stats()
+        self.send_json(404, {"message": "page not found"})
+
+    def send_logs(self, container: str, query: dict):
+        since = float(query.get("since", 0))
+        if container == "web":
+            lines = [(kind, seconds, message) for kind, seconds, message in WEB_LOGS if seconds >= int(since)]
+            lines = [line for line in lines if query.get("stderr") == "1" or line[0] != 2]
+            lines = [line for line in lines if query.get("stdout") == "1" or line[0] != 1]
+        else:
+            lines = [(1, seconds, message) for seconds, message in TTY_LOGS if seconds >= int(since)]
+        if "tail" in query:
+            lines = lines[-int(query["tail"]):]
+        if container == "web":
+            body = b"".join(bytes([kind, 0, 0, 0]) + struct.pack(">I", len(text)) + text
+                            for kind, text in ((kind, f"{stamp(seconds)} {message}\n".encode()) for kind, seconds, message in lines))
+        else:
+            body = b"".join(f"{stamp(seconds)} {message}\r\n".encode() for _, seconds, message in lines)
+        self.start_stream("application/vnd.docker.raw-stream")
+        self.write_chunks(split(body))
+
+    def send_stats(self):
+        # 与daemon一样持续推送，直到客户端断开
+        self.start_stream("application/json")
+        for tick in range(1, 200):
+            sample = {
+                "cpu_stats": {"cpu_usage": {"total_usage": tick * 50_000_000}, "system_cpu_usage": tick * 1_000_000_000, "online_cpus": 2},
+                "precpu_stats": {"cpu_usage": {"total_usage": (tick - 1) * 50_000_000}, "system_cpu_usage": (tick - 1) * 1_000_000_000},
+                "memory_stats": {"usage": 300 * 2 ** 20, "limit": 1024 * 2 ** 20, "stats": {"inactive_file": 44 * 2 ** 20}},
+                "networks": {"eth0": {"rx_bytes": 1000 * tick, "tx_bytes": 500 * tick}},
+                "blkio_stats": {"io_service_bytes_recursive": [{"op": "read", "value": 4096}, {"op": "write", "value": 8192}]},
+                "pids_stats": {"current": 3},
+            }
+            line = json.dumps(sample).encode() + b"\n"
+            try:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+            except OSError:
+                return
+            time.sleep(0.02)
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class DockerDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        self.requests = []
+        super().__init__(path, DockerHandler)
+
+
+class SSHServer(paramiko.ServerInterface):
+    """Password-accepting sshd: exec (run locally with a chosen PATH) and, unless refused, direct-streamlocal"""
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "direct-streamlocal@openssh.com":
+            path = self.transport.pending_path
+            self.stub.events.append(("streamlocal", path))
+            if self.stub.refuse_streamlocal:
+                return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+            if not os.path.exists(path):
+                return paramiko.OPEN_FAILED_CONNECT_FAILED
+            self.stub.pending[chanid] = path
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.stub.events.append(("exec", command.decode()))
+        # 稍后启动：确保exec成功的回复先于通道关闭发出
+        threading.Timer(0.05, self.stub.run_exec, args=(channel, command.decode())).start()
+        return True
+
+
+class StreamLocalServerTransport(paramiko.Transport):
+    """Records the socket path of direct-streamlocal opens, which paramiko does not parse"""
+
+    def _parse_channel_open(self, m):
+        position = m.packet.tell()
+        if m.get_text() == "direct-streamlocal@openssh.com":
+            m.get_int(), m.get_int(), m.get_int()
+            self.pending_path = m.get_text()
+        m.packet.seek(position)
+        return super()._parse_channel_open(m)
+
+
+class StubSSHD:
+    def __init__(self, host_key, refuse_streamlocal: bool, path_env: str):
+        self.host_key = host_key
+        self.refuse_streamlocal = refuse_streamlocal
+        self.path_env = path_env
+        self.events = []
+        self.pending = {}
+        self.sessions = []
+        self.transports = []
+        self.listener = socket.socket()
+        self.listener.bind((HOST, 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            transport = StreamLocalServerTransport(client)
+            transport.add_server_key(self.host_key)
+            server = SSHServer(self)
+            server.transport = transport
+            transport.start_server(server=server)
+            self.transports.append(transport)
+            threading.Thread(target=self.accept_channels, args=(transport,), daemon=True).start()
+
+    def accept_channels(self, transport):
+        while transport.is_active():
+            channel = transport.accept(0.5)
+            if channel is None:
+                continue
+            path = self.pending.pop(channel.get_id(), None)
+            if path is None:
+                # exec通道由check_channel_exec_request处理；保留引用，否则paramiko回收时会关闭通道
+                self.sessions.append(channel)
+                continue
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(path)
+            bridge(sock, channel)
+
+    def run_exec(self, channel, command):
+        process = subprocess.Popen(["/bin/sh", "-c", command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=dict(os.environ, PATH=self.path_env))
+        pumps = [threading.Thread(target=copy, args=(process.stdout.read1, channel.sendall)),
+                 threading.Thread(target=copy, args=(process.stderr.read1, channel.sendall_stderr))]
+        for pump in pumps:
+            pump.start()
+        threading.Thread(target=copy, args=(channel.recv, process.stdin.write, process.stdin.close, process.stdin.flush),
+                         daemon=True).start()
+        process.wait()
+        for pump in pumps:
+            pump.join()
+        channel.send_exit_status(process.returncode)
+        channel.close()
+
+    def close(self):
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
+
+
+def copy(read, write, done=None, flush=None):
+    try:
+        while True:
+            data = read(65536)
+            if not data:
+                break
+            write(data)
+            if flush:
+                flush()
+    except (OSError, ValueError, EOFError):
+        pass
+    if done:
+        try:
+            done()
+        except OSError:
+            pass
+
+
+def bridge(sock, channel):
+    threading.Thread(target=copy, args=(sock.recv, channel.sendall, channel.shutdown_write), daemon=True).start()
+    threading.Thread(target=copy, args=(channel.recv, sock.sendall, lambda: sock.shutdown(socket.SHUT_WR)),
+                     daemon=True).start()
+
+
+@pytest.fixture(scope="module")
+def host_key():
+    return paramiko.RSAKey.generate(2048)
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    path = str(tmp_path / "docker.sock")
+    server = DockerDaemon(path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def relay_path(tmp_path, route: str) -> str:
+    """PATH for the stub sshd's exec: a socat shim (recording its use) or python3 alone"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    os.symlink(sys.executable, bin_dir / "python3")
+    if route == "socat":
+        shim = bin_dir / "socat"
+        script = toolkit.DOCKER_RELAY_SCRIPT.replace("'", "'\\''")
+        shim.write_text(f"#!/bin/sh\n: > {tmp_path}/socat-used\n"
+                        f"exec {sys.executable} -c '{script}' \"${{2#UNIX-CONNECT:}}\"\n")
+        shim.chmod(0o755)
+    return str(bin_dir)
+
+
+@pytest.fixture(params=["local", "streamlocal", "socat", "python3"])
+def route(request, daemon, host_key, tmp_path, monkeypatch):
+    """Point the toolkit's Docker client for HOST at the stand-in daemon over one socket route"""
+    sshd = None
+    if request.param == "local":
+        monkeypatch.setitem(toolkit.host_backends, HOST, "local")
+    else:
+        monkeypatch.setitem(toolkit.host_backends, HOST, "ssh")
+        sshd = StubSSHD(host_key, refuse_streamlocal=request.param != "streamlocal", path_env=relay_path(tmp_path, request.param))
+        monkeypatch.setenv("PORT", str(sshd.port))
+        monkeypatch.setenv("USERNAME", "docker-test")
+        monkeypatch.setenv("PASSWORD", "x")
+    toolkit.docker_clients[HOST] = toolkit.DockerClient(HOST, daemon.server_address)
+    yield request.param, sshd
+    for client in toolkit.docker_clients.values():
+        client.close()
+    toolkit.docker_clients.clear()
+    toolkit.docker_log_cursors.clear()
+    toolkit.unix_forwarding_refused.clear()
+    with toolkit._pool_lock:
+        for connection in toolkit.connection_pool.values():
+            if isinstance(connection, toolkit.HostConnection):
+                connection.close()
+        toolkit.connection_pool.clear()
+    if sshd:
+        sshd.close()
+
+
+def call(tool, **kwargs):
+    return json.loads(tool(**kwargs, ip_address=HOST, format="json"))
+
+
+def test_containers_over_each_route(route, daemon, tmp_path):
+    name, sshd = route
+    result = call(toolkit.docker_containers, label="tier=front")
+    assert result["ok"], result
+    assert [row["name"] for row in result["containers"]] == ["web", "console"]
+    assert result["containers"][0]["ports"] == "0.0.0.0:8080->80/tcp"
+    assert daemon.requests[-1] == ("/containers/json", {"filters": json.dumps({"label": ["tier=front"]})})
+
+    if name == "streamlocal":
+        assert ("streamlocal", daemon.server_address) in sshd.events
+        assert not [event for event in sshd.events if event[0] == "exec"]
+    elif name in ("socat", "python3"):
+        # 拒绝转发后改用中继，并记住该主机不再尝试streamlocal
+        assert toolkit.unix_forwarding_refused[HOST]
+        assert [event for event in sshd.events if event[0] == "exec"]
+        assert os.path.exists(tmp_path / "socat-used") == (name == "socat")
+        opens = len(sshd.events)
+        assert call(toolkit.docker_containers)["ok"]
+        assert len(sshd.events) == opens
+
+
+def test_keep_alive_reuses_one_connection(route):
+    name, sshd = route
+    for _ in range(3):
+        assert call(toolkit.docker_containers)["ok"]
+    assert call(toolkit.docker_inspect, container="web")["ok"]
+    if sshd:
+        assert len(sshd.events) == 1 + (name != "streamlocal")
+
+
+def test_inspect(route):
+    result = call(toolkit.docker_inspect, container="web")
+    assert result["ok"], result
+    assert result["container"]["State"]["Pid"] == 4242
+    text = toolkit.docker_inspect("web", ip_address=HOST)
+    assert "Ports:    0.0.0.0:8080->80/tcp" in text
+    assert "Mount:    /srv/www -> /usr/share/nginx/html (bind, ro)" in text
+
+
+def test_error_statuses(route):
+    missing = call(toolkit.docker_inspect, container="missing")
+    assert not missing["ok"]
+    assert "Docker API 404: No such container: missing" in missing["error"]
+    broken = call(toolkit.docker_inspect, container="broken")
+    assert "Docker API 500: boom" in broken["error"]
+    logs = call(toolkit.docker_logs, container="missing")
+    assert "Docker API 404" in logs["error"]
+    # 错误响应后保持连接仍可继续使用
+    assert call(toolkit.docker_containers)["ok"]
+
+
+def test_missing_socket(route, tmp_path):
+    name, _ = route
+    toolkit.docker_clients[HOST] = toolkit.DockerClient(HOST, str(tmp_path / "absent.sock"))
+    result = call(toolkit.docker_containers)
+    assert not result["ok"]
+    if name == "streamlocal":
+        assert "Cannot connect to" in result["error"]
+    elif name == "python3":
+        # 中继的stderr出现在错误信息中
+        assert "No such file or directory" in result["error"]
+
+
+def test_multiplexed_logs_and_cursor(route, daemon):
+    first = call(toolkit.docker_logs, container="web", limit=3)
+    assert first["ok"], first
+    assert [(entry["stream"], entry["message"]) for entry in first["entries"]] == [
+        ("stderr", "warn: slow"), ("stdout", "GET /health"), ("stderr", "error: upstream")]
+    assert daemon.requests[-1][1]["tail"] == "3"
+
+    again = call(toolkit.docker_logs, container="web")
+    assert again["ok"] and again["entries"] == []
+
+    stdout = call(toolkit.docker_logs, container="web", stream="stdout", since="1704067201", limit=2)
+    assert [entry["message"] for entry in stdout["entries"]] == ["start", "GET /"]
+    assert stdout["more"]
+    rest = call(toolkit.docker_logs, container="web", stream="stdout", cursor=stdout["cursor"])
+    assert [entry["message"] for entry in rest["entries"]] == ["GET /health"]
+
+
+def test_tty_logs(route):
+    result = call(toolkit.docker_logs, container="console")
+    assert result["ok"], result
+    assert [(entry["stream"], entry["message"]) for entry in result["entries"]] == [
+        ("tty", "login: "), ("tty", "$ ls"), ("tty", "bin etc")]
+
+
+def test_stats_read_from_endless_streams(route):
+    result = call(toolkit.docker_stats, samples=2)
+    assert result["ok"], result
+    assert [row["container"] for row in result["containers"]] == ["web", "console"]
+    row = result["containers"][0]
+    assert row["samples"] == 2
+    assert row["cpu"] == pytest.approx(10.0)
+    assert row["mem"] == 256 * 2 ** 20
+    assert row["mem_percent"] == 25.0
+    assert (row["block_read"], row["block_write"], row["pids"]) == (4096, 8192, 3)
+    # 流不结束，读够样本即返回
+    assert result["duration"] < 5
+
+    missing = call(toolkit.docker_stats, containers=["missing"])
+    assert not missing["ok"]
+    assert "Docker API 404" in missing["containers"][0]["error"]
@@ -0,0 +1,148 @@
+"""InteractiveShell.expect: matching patterns on escape-stripped session output as it arrives.
+
+expect strips only the newly arrived output on each wake-up, keeps an escape sequence cut at a recv boundary for
+the next round, and maps the match end back to a raw offset. Its results must be the same as stripping and
+searching all unread output from scratch each time.
+"""
+import importlib
+import os
+import random
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+toolkit = importlib.import_module("linux_mcp_toolkit.main")
+
+PROMPT = re.compile(r"[$#] $", re.M)
+PASSWORD = re.compile(r"Password: ")
+ESCAPES = ["\x1b[0m", "\x1b[1;32m", "\x1b]0;user@host: ~\x07", "\x1b(B", "\x1b=", "\x1b[?2004h", "\x1bc"]
+TEXT = ["abc", "\n", "xy z", "$ ", "user@h:~$ ", "Password: ", "# ", "\r\n"]
+
+
+def session(pieces, limit=toolkit.SESSION_STREAM_CHARS):
+    """A shell whose output arrives one piece per wait; the stream closes after the last piece"""
+    shell = object.__new__(toolkit.InteractiveShell)
+    shell.stream = toolkit.SessionStream(limit)
+    shell.read_offset = 0
+    queue = list(pieces)
+
+    def wait_output(offset, timeout):
+        if queue:
+            shell.stream.append(queue.pop(0))
+        else:
+            shell.stream.set_closed(True)
+        return True
+    shell.wait_output = wait_output
+    return shell
+
+
+def reference_expect(shell, patterns):
+    """Strip and search all unread output from scratch on every wake-up"""
+    while True:
+        raw, end, _ = shell.stream.read(shell.read_offset)
+        start = end - len(raw)
+        plain, plain_marks, raw_marks = toolkit._strip_with_offsets(raw)
+        best = None
+        for index, pattern in enumerate(patterns):
+            match = pattern.search(plain)
+            if match and (best is None or match.start() < best[1].start()):
+                best = (index, match)
+        if best:
+            index, match = best
+            consumed = toolkit._raw_offset(plain_marks, raw_marks, match.end())
+            shell.read_offset = start + consumed
+            return "matched", index, match.group(0), raw[:consumed]
+        if shell.stream.closed:
+            shell.read_offset = end
+            return "eof", -1, None, raw
+        shell.wait_output(end, 1)
+
+
+def run_expect(shell, patterns, timeout=5):
+    status, index, match, raw = shell.expect(patterns, timeout)
+    return status, index, match and match.group(0), raw
+
+
+def test_strip_with_offsets():
+    raw = "a\x1b[1mbc\x1b]0;t\x07d\x1b[0m"
+    plain, plain_marks, raw_marks = toolkit._strip_with_offsets(raw)
+    assert plain == "abcd"
+    assert plain_marks == [0, 1, 3, 4]
+    assert raw_marks == [0, 5, 13, 18]
+    # 剥离后的每个偏移映射到原始文本中紧随其后（跳过转义序列）的位置
+    assert [toolkit._raw_offset(plain_marks, raw_marks, offset) for offset in range(5)] == [0, 5, 6, 13, 18]
+
+
+def test_match_consumes_through_match_end():
+    shell = session(["\x1b[32mlogin ok\x1b[0m\nuser@h:~$ ", "next output"])
+    assert run_expect(shell, [PROMPT]) == ("matched", 0, "$ ", "\x1b[32mlogin ok\x1b[0m\nuser@h:~$ ")
+    # 匹配之后的输出留给下一次读取
+    assert shell.stream.read(shell.read_offset)[0] == ""
+    assert run_expect(shell, [re.compile("output")]) == ("matched", 0, "output", "next output")
+
+
+def test_escape_split_across_pieces():
+    # 转义序列被recv边界切开：补全后整体剥离，紧跟匹配结尾的转义序列一并消费
+    shell = session(["Password\x1b[", "1m: \x1b[0m", "next"])
+    assert run_expect(shell, [PASSWORD]) == ("matched", 0, "Password: ", "Password\x1b[1m: \x1b[0m")
+    assert shell.stream.read(shell.read_offset)[0] == ""
+
+
+def test_match_spanning_pieces():
+    shell = session(["Pass", "wo", "rd: "])
+    assert run_expect(shell, [PASSWORD]) == ("matched", 0, "Password: ", "Password: ")
+
+
+def test_earliest_match_wins_and_ties_go_to_first_pattern():
+    shell = session(["Password: $ "])
+    assert run_expect(shell, [PROMPT, PASSWORD])[:3] == ("matched", 1, "Password: ")
+    shell = session(["root# "])
+    assert run_expect(shell, [re.compile("# "), PROMPT])[:2] == ("matched", 0)
+
+
+def test_eof_consumes_everything():
+    shell = session(["no prompt \x1b[1mhere", "\x1b["])
+    assert run_expect(shell, [PROMPT]) == ("eof", -1, None, "no prompt \x1b[1mhere\x1b[")
+    assert shell.read_offset == shell.stream.end
+
+
+def test_timeout():
+    shell = session([])
+    shell.stream.append("waiting")
+    shell.wait_output = lambda offset, timeout: False
+    assert run_expect(shell, [PROMPT], timeout=0) == ("timeout", -1, None, "waiting")
+    assert shell.read_offset == len("waiting")
+
+
+def test_dropped_output_restarts_from_buffer_start():
+    # 缓冲区只保留最近的输出：被丢弃部分之后出现的提示符仍能匹配
+    pieces = ["x" * 100] * 50 + ["done$ "]
+    shell = session(pieces, limit=300)
+    status, index, match, raw = run_expect(shell, [PROMPT])
+    assert (status, match) == ("matched", "$ ")
+    assert raw.endswith("done$ ")
+    assert shell.read_offset == shell.stream.end
+
+
+def test_long_output_before_match():
+    pieces = ["line %d chatty \x1b[32mok\x1b[0m\n" % i for i in range(3000)] + ["done$ "]
+    shell = session(pieces, limit=len("".join(pieces)))
+    status, index, match, raw = run_expect(shell, [PROMPT])
+    assert (status, match) == ("matched", "$ ")
+    assert raw == "".join(pieces)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_as_stripping_from_scratch(seed):
+    rnd = random.Random(seed)
+    patterns = [PROMPT, PASSWORD]
+    for _ in range(300):
+        full = "".join(rnd.choice(ESCAPES) if rnd.random() < 0.3 else rnd.choice(TEXT)
+                       for _ in range(rnd.randint(1, 40)))
+        cuts = sorted(rnd.sample(range(1, len(full)), min(len(full) - 1, rnd.randint(0, 10)))) if len(full) > 1 else []
+        pieces = [full[a:b] for a, b in zip([0] + cuts, cuts + [len(full)])]
+        shell, reference = session(pieces), session(pieces)
+        assert run_expect(shell, patterns) == reference_expect(reference, patterns), pieces
+        assert shell.read_offset == reference.read_offset, pieces
@@ -0,0 +1,60 @@
+"""The literal journal_query hands to a remote grep -F before matching the pattern in Python.
+
+Every message the pattern matches must contain the literal, or the pre-filter silently drops real matches.
+"""
+import importlib
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+toolkit = importlib.import_module("linux_mcp_toolkit.main")
+
+literal = toolkit._journal_grep_literal
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    ("connection refused", "connection refused"),
+    ("foo{0,3}bar", "bar"),
+    ("error: x{1,2}yz", "error: x"),
+    ("x{2}abc", "abc"),
+    ("abcd{3,}", "abcd"),
+    ("abc{,}def", "def"),
+    ("abc{1}", "abc"),
+    ("a{}bcd", "a{}bcd"),
+    ("ab{b", "ab{b"),
+    ("a{ 1}bc", "a{ 1}bc"),
+    (r"\d+ errors?", " error"),
+    (r"disk\.full", "disk.full"),
+    ("[abc]hello", "hello"),
+    ("[]x]hello", "hello"),
+    ("fail(ed)? to start", " to start"),
+    ("Out of memory: Kill.*process", "Out of memory: Kill"),
+])
+def test_literal(pattern, expected):
+    assert literal(pattern) == expected
+
+
+@pytest.mark.parametrize("pattern", [
+    "foo|bar", "(?i)error", "ab", "a.c", r"\d{3}", 'a"bc"d', "x*y*z*",
+])
+def test_no_literal(pattern):
+    assert literal(pattern) is None
+
+
+@pytest.mark.parametrize("pattern, message", [
+    ("foo{0,3}bar", "fobar"),
+    ("foo{0,3}bar", "foooobar"),
+    ("error: x{1,2}yz", "error: xxyz"),
+    ("abc{,}def", "abdef"),
+    ("x{2}abc", "xxabc"),
+    ("abcd{3,}", "abcddd"),
+    (r"\d+ errors?", "3 error"),
+    ("fail(ed)? to start", "fail to start"),
+    ("(foo|bar)baz!", "barbaz!"),
+])
+def test_literal_in_every_match(pattern, message):
+    assert re.search(pattern, message)
+    assert literal(pattern) in message
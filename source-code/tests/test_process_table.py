@@ -0,0 +1,168 @@
+"""The process table behind monitor_process: the /proc shell parser used without python3 and ProcessTable.
+
+The shell parser must produce the same snapshot shape as the helper's "procs" op, including for process names
+with spaces and parentheses, and ProcessTable turns two snapshots into interval CPU% and indexes them.
+"""
+import importlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+toolkit = importlib.import_module("linux_mcp_toolkit.main")
+
+HOST = "proc-test"
+
+
+def stat_line(pid, name, state="S", ppid=1, utime=0, stime=0, threads=1, starttime=0, vsize=0, rss=0):
+    """A /proc/<pid>/stat line with the fields the parser reads (everything else zero)"""
+    fields = [state, ppid] + [0] * 9 + [utime, stime, 0, 0, 0, 0, threads, 0, starttime, vsize, rss] + [0] * 10
+    return f"{pid} ({name}) " + " ".join(str(field) for field in fields)
+
+
+def shell_steps(stats, statuses="", cmdlines="", passwd="root:x:0:0::/root:/bin/sh\n"):
+    header = "4096\n100\n1000.50\n2048000\n1700000000\n"
+    outputs = [header, "\n".join(stats) + "\n", statuses, cmdlines, passwd]
+    return [{'step': index + 1, 'command': command, 'status': 'ok', 'exit_code': 0, 'stdout': output, 'stderr': ''}
+            for index, (command, output) in enumerate(zip(toolkit.PROCESS_SHELL_COMMANDS, outputs))]
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    """Serve canned batch steps to _collect_procs_shell"""
+    def serve(steps):
+        monkeypatch.setattr(toolkit, "run_batch", lambda commands, ip_address, mode="stop": steps)
+    return serve
+
+
+def test_shell_parser(batch):
+    batch(shell_steps(
+        [stat_line(1, "systemd", ppid=0, utime=50, stime=25, threads=1, starttime=10, vsize=1000, rss=3),
+         stat_line(42, "tmux: server (1)", ppid=1, state="R", threads=2, starttime=500, rss=10),
+         stat_line(43, "kworker/0:1", ppid=2, state="I")],
+        statuses="/proc/1/status:Uid:\t0\t0\t0\t0\n/proc/42/status:Uid:\t1000\t1000\t1000\t1000\n",
+        cmdlines="\n/proc/1/cmdline\t/sbin/init splash \n/proc/42/cmdline\ttmux new -s a b \n",
+        passwd="root:x:0:0::/root:/bin/sh\nalice:x:1000:1000::/home/alice:/bin/sh\n"))
+    snapshot = toolkit._collect_procs_shell(HOST)
+
+    assert snapshot['uptime'] == 1000.5
+    assert snapshot['clk_tck'] == 100
+    assert snapshot['mem_total'] == 2048000 * 1024
+    assert snapshot['time'] == 1700000000.0
+    procs = {proc['pid']: proc for proc in snapshot['procs']}
+    assert procs[1] == {"pid": 1, "name": "systemd", "state": "S", "ppid": 0, "uid": 0, "user": "root",
+                        "utime": 50, "stime": 25, "threads": 1, "starttime": 10, "vsize": 1000,
+                        "rss": 3 * 4096, "cmdline": "/sbin/init splash"}
+    assert procs[42]['name'] == "tmux: server (1)"
+    assert procs[42]['state'] == "R"
+    assert procs[42]['user'] == "alice"
+    assert procs[42]['cmdline'] == "tmux new -s a b"
+    # 内核线程没有cmdline，也可能读不到status
+    assert procs[43]['cmdline'] == ""
+    assert procs[43]['user'] == "root"
+
+
+def test_shell_parser_unknown_uid_and_garbage(batch):
+    batch(shell_steps([stat_line(7, "daemon"), "garbage without parentheses", ""],
+                      statuses="/proc/7/status:Uid:\t4242\t4242\t4242\t4242\n"))
+    procs = toolkit._collect_procs_shell(HOST)['procs']
+    assert [(proc['pid'], proc['user']) for proc in procs] == [(7, "4242")]
+
+
+def test_shell_parser_incomplete_batch(batch):
+    steps = shell_steps([stat_line(1, "init")])
+    steps[2].update(status='skipped', stdout='')
+    batch(steps)
+    with pytest.raises(Exception, match="step 3"):
+        toolkit._collect_procs_shell(HOST)
+
+
+def test_shell_parser_matches_helper(batch):
+    """On this machine the shell commands and the helper read the same fields for our own process"""
+    outputs = [subprocess.run(["sh", "-c", command], capture_output=True, text=True).stdout
+               for command in toolkit.PROCESS_SHELL_COMMANDS]
+    batch([{'step': index + 1, 'command': command, 'status': 'ok', 'exit_code': 0, 'stdout': output, 'stderr': ''}
+           for index, (command, output) in enumerate(zip(toolkit.PROCESS_SHELL_COMMANDS, outputs))])
+    shell = {proc['pid']: proc for proc in toolkit._collect_procs_shell(HOST)['procs']}
+    helper = {proc['pid']: proc for proc in toolkit.LocalHelper.ops()['procs']()['procs']}
+    ours = os.getpid()
+    for key in ("name", "ppid", "uid", "user", "starttime", "cmdline"):
+        assert shell[ours][key] == helper[ours][key], key
+
+
+def snapshot(procs, time, uptime):
+    return {'time': time, 'uptime': uptime, 'clk_tck': 100, 'mem_total': 1000 * 1024,
+            'procs': [dict(proc) for proc in procs]}
+
+
+def proc(pid, ppid=1, name="worker", user="root", utime=0, stime=0, starttime=0, rss=0, cmdline=""):
+    return {"pid": pid, "name": name, "state": "S", "ppid": ppid, "uid": 0, "user": user, "utime": utime,
+            "stime": stime, "threads": 1, "starttime": starttime, "vsize": 0, "rss": rss, "cmdline": cmdline}
+
+
+def test_lifetime_cpu_without_baseline():
+    # 运行了100秒，累计50秒CPU
+    table = toolkit.ProcessTable(snapshot([proc(10, utime=3000, stime=2000, starttime=100 * 100)], 5000.0, 200.0))
+    assert table.cpu_interval is None
+    assert table.by_pid[10]['cpu'] == 50.0
+    assert table.by_pid[10]['started'] == 5000 - 200 + 100
+
+
+def test_interval_cpu_against_baseline():
+    before = toolkit.ProcessTable(snapshot([proc(10, utime=1000), proc(11, utime=1000, starttime=5)], 5000.0, 200.0))
+    # pid 11 在两次采样间被复用（starttime变化），只能按生命周期计算
+    after = toolkit.ProcessTable(snapshot([proc(10, utime=1150, stime=50), proc(11, utime=10, starttime=19000)],
+                                          5002.0, 202.0), before)
+    assert after.cpu_interval == 2.0
+    assert after.by_pid[10]['cpu'] == 100.0
+    assert after.by_pid[11]['cpu'] == 0.8
+
+
+@pytest.mark.parametrize("interval", [0.2, toolkit.PROCESS_DELTA_MAX_AGE + 1])
+def test_baseline_outside_window_is_ignored(interval):
+    before = toolkit.ProcessTable(snapshot([proc(10, utime=0)], 5000.0, 200.0))
+    after = toolkit.ProcessTable(snapshot([proc(10, utime=2000)], 5000.0 + interval, 200.0 + interval), before)
+    assert after.cpu_interval is None
+    assert after.by_pid[10]['cpu'] == round(2000 / 100 / (200 + interval) * 100, 1)
+
+
+def test_mem_percent():
+    table = toolkit.ProcessTable(snapshot([proc(10, rss=250 * 1024)], 5000.0, 200.0))
+    assert table.by_pid[10]['mem'] == 25.0
+
+
+def test_select_and_subtree():
+    table = toolkit.ProcessTable(snapshot([
+        proc(1, ppid=0, name="init", cmdline="/sbin/init"),
+        proc(20, ppid=1, name="nginx", user="www", cmdline="nginx: master process"),
+        proc(21, ppid=20, name="nginx", user="www", cmdline="nginx: worker process"),
+        proc(22, ppid=20, name="nginx", user="www", cmdline="nginx: worker process"),
+        proc(30, ppid=21, name="sh", user="www", cmdline="sh -c ./healthcheck"),
+        proc(40, ppid=1, name="python3", cmdline="python3 -m http.server"),
+    ], 5000.0, 200.0))
+
+    assert sorted(p['pid'] for p in table.select(name="nginx")) == [20, 21, 22]
+    assert [p['pid'] for p in table.select(name="http.server")] == [40]
+    assert sorted(p['pid'] for p in table.select(pattern=r"worker|health")) == [21, 22, 30]
+    assert sorted(p['pid'] for p in table.select(name="nginx", user="www", pattern="master")) == [20]
+    assert table.select(user="nobody") == []
+    assert [(depth, p['pid']) for depth, p in table.subtree(20)] == [(0, 20), (1, 21), (2, 30), (1, 22)]
+    assert table.subtree(999) == []
+
+
+@pytest.mark.parametrize("sort_by, expected", [
+    ("cpu", [2, 3, 1]),
+    ("rss", [3, 1, 2]),
+    ("pid", [1, 2, 3]),
+    ("start", [3, 2, 1]),
+])
+def test_top(sort_by, expected):
+    table = toolkit.ProcessTable(snapshot([
+        proc(1, utime=100, rss=50, starttime=100),
+        proc(2, utime=900, rss=10, starttime=200),
+        proc(3, utime=500, rss=90, starttime=300),
+    ], 5000.0, 200.0))
+    assert [p['pid'] for p in toolkit.ProcessTable.top(list(table.by_pid.values()), sort_by, limit=3)] == expected
+    assert len(toolkit.ProcessTable.top(list(table.by_pid.values()), sort_by, limit=2)) == 2
@@ -0,0 +1,162 @@
+"""SessionStream (offset-addressed session output with a size cap) and output spool files with LRU eviction."""
+import collections
+import importlib
+import os
+import random
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+toolkit = importlib.import_module("linux_mcp_toolkit.main")
+
+
+def test_read_by_offset():
+    stream = toolkit.SessionStream()
+    for piece in ("abc", "", "defg", "h"):
+        stream.append(piece)
+    assert stream.read(0) == ("abcdefgh", 8, 0)
+    assert stream.read(2) == ("cdefgh", 8, 0)
+    assert stream.read(3) == ("defgh", 8, 0)
+    assert stream.read(8) == ("", 8, 0)
+    assert stream.read(2, max_chars=3) == ("cde", 5, 0)
+    assert stream.read(5, max_chars=100) == ("fgh", 8, 0)
+
+
+def test_limit_drops_oldest_chunks():
+    stream = toolkit.SessionStream(limit=10)
+    for piece in ("aaaa", "bbbb", "cccc", "dddd"):
+        stream.append(piece)
+    assert (stream.start, stream.end) == (8, 16)
+    # 读取已丢弃的位置时从保留的最早位置开始，并报告丢弃的字符数
+    assert stream.read(0) == ("ccccdddd", 16, 8)
+    assert stream.read(9) == ("cccdddd", 16, 0)
+
+
+def test_limit_keeps_the_last_chunk():
+    stream = toolkit.SessionStream(limit=4)
+    stream.append("ab")
+    stream.append("0123456789")
+    assert stream.read(0) == ("0123456789", 12, 2)
+
+
+def test_compaction_keeps_offsets():
+    stream = toolkit.SessionStream(limit=100)
+    rnd = random.Random(1)
+    text = []
+    for _ in range(5000):
+        piece = "x" * rnd.randint(1, 9) + "\n"
+        stream.append(piece)
+        text.append(piece)
+    full = "".join(text)
+    # 已丢弃的块会被定期压缩掉，偏移寻址不受影响
+    assert stream.head < 1100
+    assert len(stream.chunks) - stream.head == len(stream.offsets) - stream.head
+    for offset in (stream.start, stream.start + 1, stream.end - 3, stream.end):
+        assert stream.read(offset) == (full[offset:], len(full), 0)
+    assert stream.read(stream.start + 5, max_chars=7)[0] == full[stream.start + 5:stream.start + 12]
+
+
+def test_wait_wakes_on_append_and_close():
+    stream = toolkit.SessionStream()
+    assert stream.wait(0, 0.05) is False
+
+    threading.Timer(0.05, stream.append, ["data"]).start()
+    start = time.time()
+    assert stream.wait(0, 5) is True
+    assert time.time() - start < 2
+    assert stream.wait(0, 0) is True
+
+    threading.Timer(0.05, stream.set_closed, [True]).start()
+    assert stream.wait(4, 5) is True
+    assert stream.closed
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(toolkit, "SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(toolkit, "_spool_dir_ready", False)
+    monkeypatch.setattr(toolkit, "spools", collections.OrderedDict())
+    monkeypatch.setattr(toolkit, "SPOOL_THRESHOLD", 100)
+    return tmp_path
+
+
+def test_small_output_stays_in_memory(spool_dir):
+    writer = toolkit.SpoolWriter(command="echo")
+    writer.write(b"short\n")
+    assert writer.close() is None
+    assert writer.getvalue() == b"short\n"
+    assert toolkit.spool_bytes(b"x" * 100) is None
+    assert os.listdir(spool_dir) == []
+
+
+def test_spool_entry_and_lines(spool_dir):
+    data = b"".join(b"line %d\n" % i for i in range(1, 101))
+    writer = toolkit.SpoolWriter(command="seq")
+    for index in range(0, len(data), 37):
+        writer.write(data[index:index + 37])
+    entry = writer.close()
+    assert entry['command'] == "seq"
+    assert (entry['size'], entry['lines']) == (len(data), 100)
+    with open(entry['path'], 'rb') as f:
+        assert f.read() == data
+    assert toolkit.get_spool(entry['handle']) is entry
+    assert entry['head'].startswith("line 1\n") and entry['head'].endswith("line 20\n")
+    assert entry['tail'] == "".join("line %d\n" % i for i in range(81, 101))
+    with toolkit._open_spool(entry) as mm:
+        for line in (1, 2, 50, 100):
+            offset = toolkit._line_offset(entry, mm, line)
+            assert mm[offset:offset + 16].startswith(b"line %d\n" % line)
+        assert toolkit._line_offset(entry, mm, 101) == len(data)
+        assert toolkit._line_offset(entry, mm, 500) == len(data)
+
+
+def test_last_line_without_newline_is_counted(spool_dir):
+    entry = toolkit.spool_bytes(b"a\n" * 60 + b"tail")
+    assert entry['lines'] == 61
+    assert entry['tail'].endswith("tail")
+
+
+def test_eviction_by_count_in_lru_order(spool_dir, monkeypatch):
+    monkeypatch.setattr(toolkit, "SPOOL_MAX_FILES", 3)
+    entries = [toolkit.spool_bytes(b"%d" % i * 200) for i in range(3)]
+    # 读取过的条目移到队尾，最久未使用的先被淘汰
+    toolkit.get_spool(entries[0]['handle'])
+    entries.append(toolkit.spool_bytes(b"3" * 200))
+    assert list(toolkit.spools) == [entries[2]['handle'], entries[0]['handle'], entries[3]['handle']]
+    assert toolkit.get_spool(entries[1]['handle']) is None
+    assert not os.path.exists(entries[1]['path'])
+    assert sorted(os.listdir(spool_dir)) == sorted(os.path.basename(entry['path'])
+                                                   for entry in (entries[0], entries[2], entries[3]))
+
+
+def test_eviction_by_bytes(spool_dir, monkeypatch):
+    monkeypatch.setattr(toolkit, "SPOOL_MAX_BYTES", 1000)
+    first = toolkit.spool_bytes(b"a" * 400)
+    second = toolkit.spool_bytes(b"b" * 400)
+    third = toolkit.spool_bytes(b"c" * 400)
+    assert list(toolkit.spools) == [second['handle'], third['handle']]
+    assert not os.path.exists(first['path'])
+    # 单个超过上限的输出登记后立即被淘汰：仍返回首尾预览，不留下文件
+    oversized = toolkit.spool_bytes(b"d" * 2000)
+    assert oversized['head'] == "d" * 2000
+    assert toolkit.get_spool(oversized['handle']) is None
+    assert list(toolkit.spools) == []
+    assert os.listdir(spool_dir) == []
+
+
+def test_stale_spool_files_removed_on_first_use(spool_dir):
+    stale = spool_dir / "old.spool"
+    stale.write_bytes(b"x")
+    os.utime(stale, (time.time() - 2 * 86400,) * 2)
+    fresh = spool_dir / "recent.spool"
+    fresh.write_bytes(b"x")
+    other = spool_dir / "notes.txt"
+    other.write_bytes(b"x")
+    os.utime(other, (time.time() - 2 * 86400,) * 2)
+    toolkit.spool_bytes(b"y" * 200)
+    names = set(os.listdir(spool_dir))
+    assert "old.spool" not in names
+    assert {"recent.spool", "notes.txt"} <= names
@@ -0,0 +1,102 @@
+"""apply_unified_diff, the helper op behind edit_file's diff mode.
+
+Diffs produced by difflib (any context size) must reproduce the new text exactly; hunks whose line numbers have
+drifted are placed by their context, and truncated or mismatching diffs are rejected.
+"""
+import difflib
+import importlib
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+toolkit = importlib.import_module("linux_mcp_toolkit.main")
+
+apply_unified_diff = toolkit.LocalHelper.namespace()['apply_unified_diff']
+
+OLD = "".join("line %d\n" % i for i in range(1, 21))
+
+
+def make_diff(old, new, context=3):
+    return "\n".join(difflib.unified_diff(old.split("\n"), new.split("\n"), "a/file", "b/file", lineterm="", n=context))
+
+
+def edit(text, rnd):
+    lines = text.split("\n")
+    for _ in range(rnd.randint(1, 5)):
+        position = rnd.randint(0, len(lines))
+        kind = rnd.random()
+        if kind < 0.4:
+            lines[position:position] = ["new %d" % rnd.randint(0, 999) for _ in range(rnd.randint(1, 3))]
+        elif kind < 0.7:
+            del lines[position:position + rnd.randint(1, 3)]
+        else:
+            lines[position:position + 1] = ["changed %d" % rnd.randint(0, 999)]
+    return "\n".join(lines)
+
+
+@pytest.mark.parametrize("context", [0, 1, 3])
+def test_roundtrip(context):
+    rnd = random.Random(context)
+    for _ in range(200):
+        old = OLD if rnd.random() < 0.5 else OLD.rstrip("\n")
+        new = edit(old, rnd)
+        if new == old:
+            continue
+        assert apply_unified_diff(old, make_diff(old, new, context)) == new
+
+
+def test_insert_at_start_and_end_without_context():
+    old = "a\nb\n"
+    for new in ("x\na\nb\n", "a\nb\ny\n", "x\na\nb\ny\n"):
+        assert apply_unified_diff(old, make_diff(old, new, 0)) == new
+
+
+def test_create_from_empty():
+    assert apply_unified_diff("", "@@ -0,0 +1,2 @@\n+hello\n+world") == "hello\nworld\n"
+
+
+def test_drifted_line_numbers():
+    old = OLD
+    new = old.replace("line 10\n", "line ten\n")
+    diff = make_diff(old, new)
+    # 文件在生成diff后又在开头多了几行：按上下文就近定位
+    assert apply_unified_diff("header\nheader\n" + old, diff) == "header\nheader\n" + new
+    assert apply_unified_diff(old.replace("line 1\nline 2\n", ""), diff) == new.replace("line 1\nline 2\n", "")
+
+
+def test_hunk_offsets_accumulate():
+    old = OLD
+    new = old.replace("line 2\n", "line 2\nextra a\nextra b\n").replace("line 18\n", "")
+    assert apply_unified_diff(old, make_diff(old, new, 1)) == new
+
+
+def test_blank_context_lines_without_leading_space():
+    # 部分工具会去掉空上下文行行首的空格
+    old = "a\n\nb\n"
+    diff = "@@ -1,3 +1,3 @@\n a\n\n-b\n+c"
+    assert apply_unified_diff(old, diff) == "a\n\nc\n"
+
+
+def test_no_newline_marker_is_ignored():
+    diff = "--- a/f\n+++ b/f\n@@ -1 +1 @@\n-old\n\\ No newline at end of file\n+new\n\\ No newline at end of file"
+    assert apply_unified_diff("old", diff) == "new"
+
+
+def test_no_hunks():
+    with pytest.raises(ValueError, match="no hunks"):
+        apply_unified_diff(OLD, "--- a/file\n+++ b/file\n")
+
+
+def test_truncated():
+    diff = make_diff(OLD, OLD.replace("line 5\n", "line five\n"))
+    with pytest.raises(ValueError, match="truncated"):
+        apply_unified_diff(OLD, "\n".join(diff.split("\n")[:-2]))
+
+
+def test_context_mismatch():
+    diff = make_diff(OLD, OLD.replace("line 5\n", "line five\n"))
+    with pytest.raises(ValueError, match=r"hunk 1 \(line 2\): context does not match"):
+        apply_unified_diff(OLD.replace("line 4\n", "line four\n"), diff)